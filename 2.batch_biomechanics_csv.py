@@ -8,6 +8,19 @@
 # Most installations of Anaconda will include pandas and numpy 
 # Terminal tables from: https://anaconda.org/conda-forge/terminaltables
 # Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the script 
+#
+# Shard mode - for spreading the whole archive over the nodes of a cluster job array
+# Run in the top-level directory containing 'date_index.tsv' and 'tendon_data_formatted.csv':
+#   python batch_biomechanics_csv.py --shard 2/8
+# All '*Data.csv' files in the date folders are split between the N shards, balanced by file size
+# The split only depends on the files present, so a failed shard can be rerun on its own
+# Each shard writes its partial summary and error log to 'shards/shard_<i>_of_<N>/'
+# Once every shard has finished, combine them with merge_shards.py
+# Shards don't write to the results store, 'merge_shards.py --db' loads their results into it
+#
+# Before analysing anything a run plan is printed, listing every file largest first
+# Files whose name doesn't match the metadata, or whose columns or first rows aren't as expected, are rejected here
+# without being read in full. Use '--plan' to only print the plan
 
 ## Load packages
 
@@ -16,33 +29,696 @@ import numpy as np
 import os
 import sys 
 import re
+import io
 import xlrd
+import argparse
+import time
 import matplotlib.pyplot as plt
 from terminaltables import AsciiTable
+import results_db
+import phase_index
+from biomechanics_utils import SUMMARY_COLUMNS, read_date_index, parse_file_name, write_error_log, match_metadata, metadata_fields
 
 # If any packages aren't installed use package manager (preferably anaconda) to install, e.g.
 # conda install -c conda-forge terminaltables
 
-## Create empty dataframe for to output results for all samples analysed and empty array for files that couldn't be analysed
-# Results dataframe
-all_sample_summary = pd.DataFrame(columns=
-    ['File name', 'Date', 'Sample ID', 'Replicate number', 'Sex', 'Age', 'Genotype', 
-    'Sample length', 'Minimum force', 'Maximum force', 'Maximum force cycle 1', 'Maximum force cycle 5', 'Stress-relaxation', 'Rate of change of stress',
-    'Hysteresis sum value', 'Hysteresis %', 'Smoothed hysteresis sum value', 'Smoothed hysteresis %', 
-    'Average diameter', 'Circumference', 'Circumference, true', 'Max modulus', 'Stress at max modulus', 'Strain at max modulus', 'Failure stress (MPa)',
-    'Failure strain (%)', 'Failure force (N)', 'Failure extension (mm)', 'Failure time (s)'])
+## Analysis engines
+# The 'legacy' engine is the original row-by-row analysis, which the published results were made with
+# The 'fast' engine does the same sums on whole columns at once with numpy
+# Use '--verify' to check the two agree before relying on the fast engine
+ENGINES = ['legacy', 'fast']
+
+## Command line options
+# With no options the script behaves as it always has and analyses the current directory
+parser = argparse.ArgumentParser(description="Analyse all '*Data.csv' biomechanics files in the current directory.")
+parser.add_argument('--shard', metavar='i/N',
+    help="Only analyse shard i of N (numbered from 1) of all files listed by 'date_index.tsv'")
+parser.add_argument('--shard-dir', default='shards',
+    help="Directory the shard outputs are written to (default: 'shards')")
+parser.add_argument('--db', metavar='PATH',
+    help="Also store the results and error status of every file in this SQLite results store (see results_db.py)")
+parser.add_argument('--failure-only', action='store_true',
+    help="Only redo the failure analysis, reading just the failure phase of each file. "
+         "Results go to 'failure_results_summary.csv' and 'failure_error_log.txt' and the pre-conditioning outputs are left as they are")
+parser.add_argument('--plan', action='store_true',
+    help="Only print the run plan - which files would be analysed and which rejected - without analysing anything")
+parser.add_argument('--engine', choices=ENGINES, default='legacy',
+    help="Analysis engine: 'legacy' is the original row-by-row analysis, 'fast' does the same sums on whole columns (default: legacy)")
+parser.add_argument('--verify', action='store_true',
+    help="Run both engines on every file and report how far apart their results are and how long each took. "
+         "Outputs are written from the engine chosen with '--engine'")
+parser.add_argument('--compact', action='store_true',
+    help="Read the number columns as float32 and the text columns as categories to cut the memory used per file, needs '--engine fast'. "
+         "The results aren't checked for accuracy unless '--verify' is also given, which compares them with the full precision legacy engine")
+parser.add_argument('--rtol', type=float,
+    help="Relative tolerance for '--verify' (default: 1e-9, or 1e-4 with '--compact')")
+parser.add_argument('--atol', type=float,
+    help="Absolute tolerance for '--verify' (default: 1e-12, or 1e-6 with '--compact')")
+parser.add_argument('--tolerance', action='append', default=[], metavar='METRIC=RTOL',
+    help="Relative tolerance for one column of results_summary.csv in '--verify', e.g. 'Max modulus=1e-6'. Can be given more than once")
+args = parser.parse_args()
+
+# A failure-only run leaves the pre-conditioning results empty, so it mustn't replace the full results
+if args.failure_only and (args.shard is not None or args.db is not None):
+    parser.error("--failure-only can't be combined with --shard or --db")
+
+# The store is only written by one process at a time, the shards leave it to merge_shards.py
+if args.shard is not None and args.db is not None:
+    parser.error("--db can't be combined with --shard, load the shard results with 'merge_shards.py --db' instead")
+
+# Compact mode calculates the derived columns in place as float32, which the legacy engine's row-by-row loops can't
+if args.compact and args.engine != 'fast':
+    parser.error("--compact needs '--engine fast'")
+
+
+##### SHARDING #####
+
+## Parse a shard specification such as '2/8' into (2, 8)
+def parse_shard(text):
+    try:
+        shard, n_shards = [int(x) for x in text.split('/')]
+    except ValueError:
+        sys.exit("Shard '{}' not understood, it should look like '2/8' (shard 2 of 8)".format(text))
+    if n_shards < 1 or not 1 <= shard <= n_shards:
+        sys.exit("Shard '{}' is out of range, shards are numbered from 1 to N".format(text))
+    return shard, n_shards
+
+
+## List every (date folder, data file, file size) in the archive
+# Folders are taken from 'date_index.tsv', files are sorted by name so the list is the same on every node
+def list_work_items(dir):
+    items = []
+    for folder in read_date_index(dir):
+        if not os.path.isdir("{}/{}".format(dir, folder)):
+            print("Folder {} listed in 'date_index.tsv' not found, skipping...".format(folder))
+            continue
+        for file in sorted(os.listdir("{}/{}".format(dir, folder))):
+            if file.endswith('Data.csv'):
+                items.append((folder, file, os.path.getsize("{}/{}/{}".format(dir, folder, file))))
+    return items
+
+
+## Split the work items between shards, balanced by file size
+# Largest files first, each going to the shard with the least data so far (lowest shard number on a tie)
+# Returns one list of work items per shard
+def assign_shards(items, n_shards):
+    shards = [[] for i in range(n_shards)]
+    totals = [0] * n_shards
+    for item in sorted(items, key=lambda item: (-item[2], item[0], item[1])):
+        lightest = totals.index(min(totals))
+        shards[lightest].append(item)
+        totals[lightest] += item[2]
+    return [sorted(shard) for shard in shards]
+
+
+##### ENGINES #####
+# The fast engine's whole column sums and compact mode, the engines are listed above the command line options
+
+## Compact mode
+# With '--compact' the number columns are read and the derived columns calculated as float32,
+# and the text columns (e.g. 'SetName' and 'Cycle') are read as categories, which is where most of the memory per file goes
+# The derived columns are added in place to the phase dataframes, keeping their type
+# Processed tables are written with the 7 significant figures float32 holds
+COMPACT_FLOAT_FORMAT = '%.7g'
+
+# Default '--verify' tolerances, compact mode is compared with the full precision legacy engine so needs looser ones
+DEFAULT_TOLERANCES = {False: (1e-9, 1e-12), True: (1e-4, 1e-6)}
+
+## Area under the curve between each row and the next, the last row has none
+# Same sum as the row-by-row loop of the legacy engine, for all rows at once
+def area_under_curve(load, displacement):
+    area = np.full(len(load), np.nan, dtype=load.dtype)
+    area[:-1] = (0.1*(load[1:] + load[:-1])*(displacement[1:] - displacement[:-1]))
+    return area
+
+
+## Modulus between the rows 5 after and 4 before each row, from 'start' to 5 rows before the end
+# Same sum as the row-by-row loop of the legacy engine, for all rows at once
+# As with 'iloc' in the loop, negative row numbers count back from the end
+def moving_modulus(stress, strain, start):
+    rows = np.arange(start, len(stress)-5)
+    if len(rows) == 0:
+        raise ValueError("Not enough failure data after the start of the stretch to calculate the modulus")
+    modulus = np.full(len(stress), np.nan, dtype=stress.dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        modulus[rows] = ((stress[rows+5] - stress[rows-4])/(strain[rows+5] - strain[rows-4]))
+    return modulus
+
+
+## Rolling mean over 5 rows, keeping the column's type (pandas always gives float64)
+def rolling_mean(column):
+    return column.rolling(window=5).mean().astype(column.dtype, copy=False)
+
+
+##### PRE-CONDITIONING #####
+# Adds the corrected and area under curve columns to 'precon_df' and returns the pre-conditioning results
+
+def analyse_precon(precon_df, engine='legacy'):
+
+    if precon_df.shape[0] < 2:
+        raise ValueError("Not enough pre-conditioning data")
+
+    ## Pre-conditioning analysis - normalise/correct data
+
+    # Minimum force
+    minf = precon_df['Force_N'].min()
+
+    # Sample length
+    sample_length = precon_df.iloc[0,3]
+
+    # Load correction
+    precon_df['Load_correction'] = precon_df['Force_N'] - minf 
+    # Alternative: 
+    #precon_df['Load_correction'] = precon_df.iloc[:, 5] - minf
+
+    # Displacement correction 
+    precon_df['Displacement_correction'] = precon_df['Displacement_mm'] - minf 
+    # Alternative: 
+    #precon_df['Displacement_correction'] = precon_df.iloc[:, 4] - minf
+
+    # Area under curve
+    if engine == 'fast':
+        precon_df['Area_under_curve'] = area_under_curve(precon_df.iloc[:,6].values, precon_df.iloc[:,7].values)
+    else:
+        for j in range(0,precon_df.shape[0]-1):
+            precon_df.loc[precon_df.index[j],'Area_under_curve'] = (0.1*(precon_df.iloc[j+1,6] + precon_df.iloc[j,6])*(precon_df.iloc[j+1,7] - precon_df.iloc[j,7]))
+
+    # Load correction smooth 
+    precon_df['Load_correction_smoothed'] = rolling_mean(precon_df['Load_correction'])
+
+    # Area under curve smooth
+    if engine == 'fast':
+        precon_df['Area_under_curve_smooth'] = area_under_curve(precon_df.iloc[:,9].values, precon_df.iloc[:,7].values)
+    else:
+        for j in range(0,precon_df.shape[0]-1):
+            precon_df.loc[precon_df.index[j],'Area_under_curve_smooth'] = (0.1*(precon_df.iloc[j+1,9] + precon_df.iloc[j,9])*(precon_df.iloc[j+1,7] - precon_df.iloc[j,7]))
+
+    ## Pre-conditioning analysis - stress relaxation
+
+    # Max force
+    maxforce = precon_df['Force_N'].max()
+
+    # Max force cycle 1 and cycle 5 
+    maxforce_c1 = precon_df.loc[precon_df.Cycle.str.contains('1'), 'Force_N'].max()
+    maxforce_c5 = precon_df.loc[precon_df.Cycle.str.contains('5'), 'Force_N'].max()
+
+    # Stress-relaxation 
+    stress_relaxation = (((maxforce_c1-maxforce_c5)/maxforce_c1)*100)
+
+    ## Pre-conditioning analysis  - hysteresis 
+
+    # Hysteresis
+    # Sum of beginning of cycle 1 to last positive value in cycle 1
+    hysteresis_positive = precon_df.loc[(precon_df.Cycle.str.contains('1')) & (precon_df['Area_under_curve'] > 0), 'Area_under_curve'].sum()
+    # Sum of first negative value in cycle 5 to last negative value in cycle 5
+    hysteresis_negative = precon_df.loc[(precon_df.Cycle.str.contains('5')) & (precon_df['Area_under_curve'] < 0), 'Area_under_curve'].sum()
+    # Add the two together to calculate sum value
+    hysteresis_sum = hysteresis_positive + hysteresis_negative
+    # Then calculate percentage
+    percentage = (hysteresis_sum/hysteresis_positive)*100
+
+
+    # Hysteresis smooth 
+    # Repeat the same process but for the smoothed area under the curve values
+    smooth_hysteresis_positive = precon_df.loc[(precon_df.Cycle.str.contains('1')) & (precon_df['Area_under_curve_smooth'] > 0), 'Area_under_curve_smooth'].sum()
+    smooth_hysteresis_negative = precon_df.loc[(precon_df.Cycle.str.contains('5')) & (precon_df['Area_under_curve_smooth'] < 0), 'Area_under_curve_smooth'].sum()
+    smooth_hysteresis_sum = hysteresis_positive + hysteresis_negative
+    smooth_percentage = (hysteresis_sum/hysteresis_positive)*100
+
+    return {
+        'Sample length': sample_length, 
+        'Minimum force': minf, 
+        'Maximum force': maxforce, 
+        'Maximum force cycle 1': maxforce_c1, 
+        'Maximum force cycle 5': maxforce_c5,
+        'Stress-relaxation': stress_relaxation, 
+        'Hysteresis positive value': hysteresis_positive, 
+        'Hysteresis sum value': hysteresis_sum, 
+        'Hysteresis %': percentage, 
+        'Smoothed hysteresis sum value': smooth_hysteresis_sum,
+        'Smoothed hysteresis %': smooth_percentage}
+
+
+##### STRESS-RELAXATION #####
+# Only rows 0 and 6000 of the stress-relaxation phase are used
+
+STRESSRELAX_ROWS = 6001
+
+def analyse_stressrelax(stressrelax_df):
+    stress_rate = ((stressrelax_df.iloc[0,5] - stressrelax_df.iloc[6000,5])/60)
+    return {'Rate of change of stress': stress_rate}
+
+
+##### FAILURE #####
+# Adds the corrected, stress/strain and modulus columns to 'failure_df' and returns the failure results
+
+def analyse_failure(failure_df, sample_length, sample_metadata, engine='legacy'):
+
+    ## Failure analysis - normalise/correct data
+
+    # Load correction
+    #failure_df['Load_correction'] = failure_df['Force_N'] - minf 
+    failure_df['Load_correction'] = failure_df.iloc[:, 5] - failure_df.iloc[0, 5]
+
+    # Displacement correction 
+    #failure_df['Displacement_correction'] = failure_df['Displacement_mm'] - minf 
+    failure_df['Displacement_correction'] = failure_df.iloc[:, 4] - failure_df.iloc[0, 4]
+
+    # Strain % 
+    failure_df['Strain_%'] = (failure_df['Displacement_correction']/sample_length)*100
+
+    # Strain (mm)
+    failure_df['Strain_mm'] = failure_df['Displacement_correction']/sample_length
+
+    # Stress (Mpas)
+    circumference_true = float(sample_metadata.iloc[0,9])
+    # extract the true circumference value from the metadata
+    # make use of float fuction to convert string from dataframe into a float value (number with a decimal place)
+    failure_df['Stress_Mpas'] = failure_df['Load_correction']/circumference_true
+
+    ## Failure analysis - modulus columns
+
+    # Need starting point for iteration in the modulus calculation
+    # To calculate find where stretch phase begins
+    # Create index for whole failure sheet and just the stretch phase
+    stretch_index = failure_df.loc[(failure_df.Cycle.str.contains('Stretch'))]
+    stretch_index = np.array(pd.Index.tolist(stretch_index.index))
+    failure_index = np.array(pd.Index.tolist(failure_df.index))
+
+    # 'Stress @ 2positions before stretch as a moving value'
+    # Subtract the first value in the whole failure sheet index from the point where the stretch cycle starts, then subtract an addition 2 
+    modulus_start = (stretch_index[0] - failure_index[0]) - 2
+
+    # Modulus (Mpa)
+    # The moving value is 10 rows apart, starting 2 positions before stretch
+    # Hence the +5 and -4 either side of the starting position 
+    if engine == 'fast':
+        failure_df['Modulus_mpa'] = moving_modulus(failure_df.iloc[:,10].values, failure_df.iloc[:,9].values, modulus_start)
+    else:
+        for j in range(modulus_start,failure_df.shape[0]-5):
+            failure_df.loc[failure_df.index[j],'Modulus_mpa'] = ((failure_df.iloc[j+5,10] - failure_df.iloc[j-4,10])/(failure_df.iloc[j+5,9] - failure_df.iloc[j-4,9]))
+
+    # Modulus - smooth 
+    failure_df['Modulus_smooth'] = rolling_mean(failure_df['Modulus_mpa'])
+
+    ## Failure analysis - modulus calculations 
+
+    # Calculate the stress value at which failure occurs
+    # Then use this to calculate strain, force and extension at which failure occurs
+    failure_stress = failure_df['Stress_Mpas'].max()
+    failure_strain_percent = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 8]
+    failure_force = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 6]
+    failure_extension = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 7]
+    failure_time = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 2]
+
+    #Subset failure column to remove everything after failure point for max modulus calculation
+    subset_f = failure_df.iloc[0:failure_df['Stress_Mpas'].argmax(), ]
+
+    # Calculate max modulus and stress/strain at max modulus on the newly subsetted version of the failure df
+    # (The full failure df will be the one saved at the end)
+    max_modulus = subset_f['Modulus_smooth'].max()
+    stress_at_max_modulus = subset_f.iloc[subset_f['Modulus_smooth'].argmax(), 10]
+    strain_at_max_modulus = subset_f.iloc[subset_f['Modulus_smooth'].argmax(), 9]
+
+    return {
+        'Max modulus': max_modulus, 
+        'Stress at max modulus': stress_at_max_modulus,
+        'Strain at max modulus': strain_at_max_modulus, 
+        'Failure stress (MPa)': failure_stress,
+        'Failure strain (%)': failure_strain_percent,
+        'Failure force (N)': failure_force,
+        'Failure extension (mm)': failure_extension,
+        'Failure time (s)': failure_time}
+
+
+##### PROCESSING #####
+
+## Pre-conditioning output 
+def write_precon_output(dir, name, precon_df, results, float_format=None):
+
+    # Pre-conditioning summary tables
+    force_data = [
+        ['General summary', ''],
+        ['Sample length', results['Sample length']],
+        ['Minimum force', results['Minimum force']],
+        ['Maximum force', results['Maximum force']],
+        ['Maximum force cycle 1', results['Maximum force cycle 1']],
+        ['Maximum force cycle 5', results['Maximum force cycle 5']],
+        ['Stress-relaxtion', results['Stress-relaxation']]
+    ]
+    force_table = AsciiTable(force_data)
+
+    hysteresis_data = [
+        ['Hysteresis', 'Cycl 1-5'],
+        ['Positive value', results['Hysteresis positive value']],
+        ['Sum value', results['Hysteresis sum value']],
+        ['Hysteresis %', results['Hysteresis %']]
+    ]
+    hysteresis_table = AsciiTable(hysteresis_data)
+
+    # Processed precon table as csv
+    precon_df.to_csv("{}/{}/precon_{}.csv".format(dir, name, name), index=False, float_format=float_format)
+
+    # Summary data as .txt file
+    with open("{}/{}/precon_summary_{}.txt".format(dir, name, name), 'w') as f:
+        print("Summary data for {} preconditioning...\n".format(name), file=f)
+        print(force_table.table, file=f) 
+        print(hysteresis_table.table, file=f) 
+        f.close()
+
+
+## Failure output
+def write_failure_output(dir, name, failure_df, results, float_format=None):
+
+    # Failure summary table
+    modulus_data = [
+        ['Summary', ''],
+        ['Max modulus', results['Max modulus']],
+        ['Stress at max modulus', results['Stress at max modulus']],
+        ['Strain at max modulus', results['Strain at max modulus']],
+        ['Failure stress (MPa)', results['Failure stress (MPa)']],
+        ['Failure strain (%)', results['Failure strain (%)']],
+        ['Failure force (N)', results['Failure force (N)']],
+        ['Failure extension (mm)', results['Failure extension (mm)']]
+    ]
+    modulus_table = AsciiTable(modulus_data)
+
+    # Processed failure table as csv
+    failure_df.to_csv("{}/{}/failure_{}.csv".format(dir, name, name), index=False, float_format=float_format)
+
+    # Summary data as .txt file
+    with open("{}/{}/failure_summary_{}.txt".format(dir, name, name), 'w') as f:
+        print("Summary data for {} failure...\n".format(name), file=f)
+        print(modulus_table.table, file=f) 
+        f.close()
+
+
+##### ANALYSE ONE FILE #####
+
+## Run the analysis of the three phases with one engine
+# The derived columns are added to the phase dataframes, returns the results of each phase
+def run_analysis(precon_df, stressrelax_df, failure_df, sample_metadata, engine='legacy', failure_only=False):
+    if failure_only:
+        precon_results = {'Sample length': precon_df.iloc[0,3]}
+        stressrelax_results = {}
+    else:
+        precon_results = analyse_precon(precon_df, engine)
+        stressrelax_results = analyse_stressrelax(stressrelax_df)
+    failure_results = analyse_failure(failure_df, precon_results['Sample length'], sample_metadata, engine)
+    return precon_results, stressrelax_results, failure_results
+
+
+## Convert a result to a python number for the results summary
+# Compact mode's results are rounded to the 7 significant figures float32 holds, including those worked out
+# from float32 values as float64, so e.g. 10.2 is written as 10.2 rather than 10.199999809265137
+def summary_value(value, compact=False):
+    if compact and isinstance(value, (float, np.floating)):
+        return float(COMPACT_FLOAT_FORMAT % value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+## Row of the results summary for one sample
+def summary_row(name, sample_metadata, phase_results, compact=False):
+    sample_summary = metadata_fields(sample_metadata)
+    sample_summary['File name'] = name
+    for results in phase_results:
+        sample_summary.update((column, summary_value(value, compact))
+            for column, value in results.items() if column in SUMMARY_COLUMNS)
+    return sample_summary
+
+
+## Read the phases of a data file that the analysis needs
+# Returns the pre-conditioning, stress-relaxation and failure dataframes (stress-relaxation is None with 'failure_only')
+def load_phases(path, index, failure_only=False, compact=False):
+    dtypes = {'float_dtype': 'float32', 'str_dtype': 'category'} if compact else {}
+    if failure_only:
+        # Only the sample length is needed from the pre-conditioning, which is in its first row
+        precon_df = phase_index.read_phase(path, index, phase_index.PRECON, nrows=1, **dtypes)
+        stressrelax_df = None
+    else:
+        precon_df = phase_index.read_phase(path, index, phase_index.PRECON, **dtypes)
+        stressrelax_df = phase_index.read_phase(path, index, phase_index.STRESSRELAX, nrows=STRESSRELAX_ROWS, **dtypes)
+    failure_df = phase_index.read_phase(path, index, phase_index.FAILURE, **dtypes)
+    return precon_df, stressrelax_df, failure_df
+
+
+# Carries out the full analysis of one '*Data.csv' file in the folder 'dir', which has been checked by plan_file
+# Processed tables and summaries are written to a sub-directory named after the file
+# Returns the row for the results summary
+# Any problem with the data raises an exception, which is written to the error log by the caller
+# With 'failure_only' only the failure phase is analysed, the pre-conditioning and stress-relaxation results are left empty
+# With 'compact' the phases are read and analysed as float32
+# If a 'verification' list is given the full precision legacy engine is run as the reference and the fast engine
+# (compact if asked for) as the candidate, their summaries and timings are added to the list and the outputs are
+# written from the engine asked for
+
+def analyse_file(dir, file, sample_metadata, engine='legacy', failure_only=False, compact=False, verification=None):
+    print("Carrying out analysis for dataset {}...".format(file))
+
+    name = parse_file_name(file)[0]
+
+    ## Create seperate dataframes for each of the analyses
+    # These are the equivalent of the different sheets in excel 
+    # The phase index gives where each phase is in the file, so only the rows needed are read
+
+    path = "{}/{}".format(dir, file)
+    index = phase_index.load_index(path)
+
+    ##### ANALYSIS #####
+
+    if verification is None:
+        precon_df, stressrelax_df, failure_df = load_phases(path, index, failure_only, compact)
+        phase_results = run_analysis(precon_df, stressrelax_df, failure_df, sample_metadata, engine, failure_only)
+
+    else:
+        # Each run reads its own copy of the data, and only the analysis itself is timed
+        runs = []
+        for run_engine, run_compact in [('legacy', False), ('fast', compact)]:
+            phase_dfs = load_phases(path, index, failure_only, run_compact)
+            start = time.time()
+            run_results = run_analysis(phase_dfs[0], phase_dfs[1], phase_dfs[2], sample_metadata, run_engine, failure_only)
+            runs.append((phase_dfs, run_results, time.time() - start))
+
+        # Keep the run of the engine asked for and let the other be freed
+        reference, candidate = runs
+        precon_df, stressrelax_df, failure_df = candidate[0] if engine == 'fast' else reference[0]
+        phase_results = candidate[1] if engine == 'fast' else reference[1]
+        verification.append({'File name': name,
+            'reference': summary_row(name, sample_metadata, reference[1]),
+            'candidate': summary_row(name, sample_metadata, candidate[1], compact),
+            'reference_time': reference[2], 'candidate_time': candidate[2]})
+        del runs, reference, candidate
+
+    precon_results, stressrelax_results, failure_results = phase_results
+
+    ##### PROCESSING #####
+
+    ## Create directory for output files
+
+    if not os.path.exists("{}/{}".format(dir, name)):
+        os.makedirs("{}/{}".format(dir, name))
+
+    float_format = COMPACT_FLOAT_FORMAT if compact else None
+    if not failure_only:
+        write_precon_output(dir, name, precon_df, precon_results, float_format)
+    write_failure_output(dir, name, failure_df, failure_results, float_format)
+
+    ## Return current sample data for the overall summary
+    return summary_row(name, sample_metadata, phase_results, compact)
+
+
+##### VERIFICATION #####
+# Compares the summaries of the two engines for every sample analysed with '--verify'
+
+## Whether a summary value is a number that can be compared with a tolerance
+def is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+
+
+## Compare the reference and candidate summaries of one sample, column by column
+# Numbers agree if they're within 'atol' + 'rtol' x the reference value (or both missing), anything else has to match exactly
+# 'tolerances' gives the rtol of any column that doesn't use the default
+def compare_summaries(reference, candidate, rtol, atol, tolerances):
+    comparison = []
+    for column in SUMMARY_COLUMNS:
+        expected, actual = reference.get(column), candidate.get(column)
+        column_rtol = tolerances.get(column, rtol)
+
+        if is_number(expected) and is_number(actual):
+            if np.isnan(expected) and np.isnan(actual):
+                difference, relative, within = 0.0, 0.0, True
+            else:
+                difference = abs(float(actual) - float(expected))
+                relative = difference / abs(float(expected)) if expected != 0 else (0.0 if difference == 0 else np.inf)
+                within = bool(difference <= atol + column_rtol * abs(float(expected)))
+        else:
+            missing = (expected is None or pd.isnull(expected)) and (actual is None or pd.isnull(actual))
+            difference, relative, within = np.nan, np.nan, bool(missing or expected == actual)
+
+        comparison.append({'Metric': column, 'Reference': expected, 'Candidate': actual,
+            'Difference': difference, 'Relative difference': relative, 'Tolerance (rtol)': column_rtol, 'Within tolerance': within})
+    return comparison
+
+
+## Parse the '--tolerance METRIC=RTOL' options into a dict of per-column tolerances
+def parse_tolerances(options):
+    tolerances = {}
+    for option in options:
+        column, _, value = option.rpartition('=')
+        if column not in SUMMARY_COLUMNS:
+            sys.exit("Tolerance '{}' not understood, it should be a results_summary.csv column and a relative tolerance, e.g. 'Max modulus=1e-6'".format(option))
+        try:
+            tolerances[column] = float(value)
+        except ValueError:
+            sys.exit("Tolerance '{}' not understood, it should be a results_summary.csv column and a relative tolerance, e.g. 'Max modulus=1e-6'".format(option))
+    return tolerances
+
+
+## Write the verification report and print a summary of it
+# 'verify_report.csv' has every metric of every sample, 'verify_timing.csv' the time each engine took per sample
+def write_verification(out_dir, verification, rtol, atol, tolerances):
+    if not verification:
+        print("No samples were analysed, nothing to verify\n")
+        return
+
+    report = []
+    timing = []
+    for sample in verification:
+        for row in compare_summaries(sample['reference'], sample['candidate'], rtol, atol, tolerances):
+            report.append(dict(row, **{'File name': sample['File name']}))
+        timing.append({'File name': sample['File name'],
+            'Legacy time (s)': sample['reference_time'], 'Fast time (s)': sample['candidate_time'],
+            'Speedup': sample['reference_time'] / sample['candidate_time'] if sample['candidate_time'] > 0 else np.nan})
+
+    report = pd.DataFrame(report, columns=['File name', 'Metric', 'Reference', 'Candidate', 'Difference',
+        'Relative difference', 'Tolerance (rtol)', 'Within tolerance'])
+    timing = pd.DataFrame(timing, columns=['File name', 'Legacy time (s)', 'Fast time (s)', 'Speedup'])
+    report.to_csv("{}/verify_report.csv".format(out_dir), index=False)
+    timing.to_csv("{}/verify_timing.csv".format(out_dir), index=False)
+
+    # Worst difference of each metric across all samples
+    verify_data = [['Metric', 'Max difference', 'Max relative difference', 'Outside tolerance']]
+    for column in SUMMARY_COLUMNS:
+        metric = report[report['Metric'] == column]
+        verify_data.append([column, metric['Difference'].max(), metric['Relative difference'].max(), int((~metric['Within tolerance']).sum())])
+    print(AsciiTable(verify_data).table)
+
+    outside = int((~report['Within tolerance']).sum())
+    print("Verified {} samples: {} values outside tolerance, fast engine {:.1f}x faster overall (see verify_report.csv and verify_timing.csv)\n".format(
+        len(verification), outside, timing['Legacy time (s)'].sum() / timing['Fast time (s)'].sum() if timing['Fast time (s)'].sum() > 0 else np.nan))
+    if outside:
+        print("WARNING: the engines disagree for some samples, check verify_report.csv before using the fast engine")
+
+
+##### RUN PLAN #####
+# Every file is checked before any of them are analysed, so files that can't be analysed are rejected cheaply
+# Only the file name, the metadata and the start and end of the file are looked at
+
+# Columns the analysis needs - force and displacement are also read by position, so these have to be where expected
+REQUIRED_COLUMNS = ['SetName', 'Cycle', 'Time_S', 'Displacement_mm', 'Force_N']
+DISPLACEMENT_COLUMN = 4
+FORCE_COLUMN = 5
+
+## Read the last row of a data file without reading the rest of it
+# Seeks to near the end of the file and reads back further until it has a whole line
+def read_last_row(path, columns, block_size=4096):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        tail = b''
+        while size > len(tail):
+            f.seek(max(0, size - len(tail) - block_size))
+            tail = f.read(size - len(tail) - f.tell()) + tail
+            lines = tail.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1:
+                break
+    return pd.read_csv(io.BytesIO(lines[-1]), header=None, names=columns).iloc[0]
+
+## Check one file and return its entry in the run plan
+# The entry's status is 'ok', 'unmatched' if no metadata matches the file name, or 'error' for any other problem
+def plan_file(dir, folder, file, metadata, failure_only=False):
+    folder_dir = dir if folder is None else "{}/{}".format(dir, folder)
+    path = "{}/{}".format(folder_dir, file)
+    entry = {'dir': folder_dir, 'folder': folder, 'file': file, 'size': os.path.getsize(path),
+        'label': file if folder is None else "{}/{}".format(folder, file),
+        'sample_metadata': None, 'status': 'ok', 'reason': ''}
+
+    ## Meta-data
+    # A file name that can't be parsed can't be matched to the metadata either
+    try:
+        name, dateID, sampleID, replicateID = parse_file_name(file)
+    except ValueError:
+        entry.update(status='unmatched', reason='File name not understood')
+        return entry
+
+    sample_metadata = match_metadata(metadata, dateID, sampleID, replicateID)
+    if sample_metadata.empty:
+        entry.update(status='unmatched', reason='No metadata for {} {} {}'.format(dateID, sampleID, replicateID))
+        return entry
+    entry['sample_metadata'] = sample_metadata
+
+    ## Header and first row
+    try:
+        start_df = pd.read_csv(path, header=0, nrows=1)
+    except Exception as e:
+        entry.update(status='error', reason="Couldn't read start of file: {}".format(e))
+        return entry
+
+    columns = list(start_df.columns)
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        entry.update(status='error', reason='Missing columns {}'.format(', '.join(missing)))
+        return entry
+    if columns.index('Displacement_mm') != DISPLACEMENT_COLUMN or columns.index('Force_N') != FORCE_COLUMN:
+        entry.update(status='error', reason='Displacement_mm and Force_N not in columns 5 and 6')
+        return entry
+    if start_df.empty:
+        entry.update(status='error', reason='No data rows')
+        return entry
+
+    ## Phases
+    # Checked in full if the file already has a phase index
+    # Otherwise the last row has to be from the failure phase, as the test ends with it
+    index = phase_index.cached_index(path)
+    if index is not None:
+        if phase_index.phase_rows(index, phase_index.FAILURE) == 0:
+            entry.update(status='error', reason='No failure data')
+        elif not failure_only and phase_index.phase_rows(index, phase_index.STRESSRELAX) < STRESSRELAX_ROWS:
+            entry.update(status='error', reason='Fewer than {} stress-relaxation rows'.format(STRESSRELAX_ROWS))
+    else:
+        try:
+            last_row = read_last_row(path, columns)
+        except Exception as e:
+            entry.update(status='error', reason="Couldn't read end of file: {}".format(e))
+            return entry
+        if phase_index.FAILURE not in str(last_row['SetName']):
+            entry.update(status='error', reason="Doesn't end with failure data")
+
+    return entry
+
+
+## Print the run plan as a table, largest files first
+def print_plan(plan):
+    plan_data = [['File', 'Size (MB)', 'Genotype', 'Age', 'Status']]
+    for entry in sorted(plan, key=lambda entry: -entry['size']):
+        sample_metadata = entry['sample_metadata']
+        plan_data.append([entry['label'], '{:.1f}'.format(entry['size'] / 1e6),
+            '' if sample_metadata is None else sample_metadata.iloc[0,5],
+            '' if sample_metadata is None else sample_metadata.iloc[0,4],
+            entry['status'] if entry['status'] == 'ok' else '{} - {}'.format(entry['status'], entry['reason'])])
+    print(AsciiTable(plan_data).table)
+
+    accepted = [entry for entry in plan if entry['status'] == 'ok']
+    print("Run plan: {} files to analyse ({:.1f} MB), {} rejected\n".format(
+        len(accepted), sum(entry['size'] for entry in accepted) / 1e6, len(plan) - len(accepted)))
 
-# Error log array
-# This will contain the names of the files that couldn't be matched to the metadata file 
-error_log = []
-# This will contain the names of files that threw up other errors during the processing 
-error_log_2 = []
 
 ## Read in data
 
 # Get current working directory 
 dir = os.getcwd()
-files = os.listdir(dir)
 
 # Check sample metadata file exists, the script can't be ran without this
 print("Checking to see if formatted sample meta-data file 'tendon_data_formatted.csv' is present in analysis directory...")
@@ -55,294 +731,125 @@ if os.path.isfile("tendon_data_formatted.csv"):
 else:
     sys.exit("Meta-data not found! Please make sure 'tendon_data_formatted.csv' is present in the same directory as the data. Terminating analysis...")
 
-##### READ IN FILES AND CREATE DATAFRAMES #####
-# Script takes in all files in the variable 'files' and interates through them
-# It includes a conditional statement to make sure the file ends in 'Data.xlsx', so only the relevant files are analysed
-for file in files:
-        if file.endswith('Data.csv'):
-            print("Carrying out analysis for dataset {}...".format(file))
-
-            file = str(file)
-            df = pd.read_csv("{}".format(file), header=0)
-
-            ## Create seperate dataframes for each of the analyses
-            # These are the equivalent of the different sheets in excel 
-
-            precon_df = df[df['SetName'].str.contains('5x pre-conditioning')]
-            stressrelax_df = df[df['SetName'].str.contains('Stress-relax')]
-            failure_df = df[df['SetName'].str.contains('Failure')]
-
-            ##### EXTRACT META-DATA #####
-
-            name = os.path.splitext(file)[0]
-            excel_annotation = re.split('(\d+)', name)
-            sampleID = excel_annotation[2][-1]
-            dateID = excel_annotation[1]
-            replicateID = excel_annotation[3]
-            sample_metadata = metadata.loc[(metadata.Date_ID == dateID) & (metadata.Sample_ID == sampleID) & (metadata.Replicate == replicateID)]
-
-            ##### META-DATA QC #####
-
-            # If the metadata was located in the previous step the analysis will be carried out ('sample_metadata' populated)
-            # If not then the analysis will be skipped and the file name will be written to an error file ('sample_metadata' empty)
-
-            if not sample_metadata.empty:
-                try:
-                    print('Found metadata matching sample file name! Continuing analysis...\n')
-                    
-                    ##### PRE-CONDITIONING #####
-
-                    ## Pre-conditioning analysis - normalise/correct data
-
-                    # Minimum force
-                    minf = precon_df['Force_N'].min()
+## Work out which files to analyse, as (folder, file) pairs - the folder is None for the current directory
+# Without '--shard' that is every file in the current directory, written out as before
+# With '--shard' it is this shard's share of the whole archive, written to the shard directory
+if args.shard is None:
+    out_dir = dir
+    work_items = [(None, file) for file in os.listdir(dir)]
 
-                    # Sample length
-                    sample_length = precon_df.iloc[0,3]
-
-                    # Load correction
-                    precon_df['Load_correction'] = precon_df['Force_N'] - minf 
-                    # Alternative: 
-                    #precon_df['Load_correction'] = precon_df.iloc[:, 5] - minf
-
-                    # Displacement correction 
-                    precon_df['Displacement_correction'] = precon_df['Displacement_mm'] - minf 
-                    # Alternative: 
-                    #precon_df['Displacement_correction'] = precon_df.iloc[:, 4] - minf
-
-                    # Area under curve
-                    for j in range(0,precon_df.shape[0]-1):
-                        precon_df.loc[precon_df.index[j],'Area_under_curve'] = (0.1*(precon_df.iloc[j+1,6] + precon_df.iloc[j,6])*(precon_df.iloc[j+1,7] - precon_df.iloc[j,7]))
-
-                    # Load correction smooth 
-                    precon_df['Load_correction_smoothed'] = precon_df['Load_correction'].rolling(window=5).mean()
-
-                    # Area under curve smooth
-                    for j in range(0,precon_df.shape[0]-1):
-                        precon_df.loc[precon_df.index[j],'Area_under_curve_smooth'] = (0.1*(precon_df.iloc[j+1,9] + precon_df.iloc[j,9])*(precon_df.iloc[j+1,7] - precon_df.iloc[j,7]))
-
-                    ## Pre-conditioning analysis - stress relaxation
-
-                    # Max force
-                    maxforce = precon_df['Force_N'].max()
-
-                    # Max force cycle 1 and cycle 5 
-                    maxforce_c1 = precon_df.loc[precon_df.Cycle.str.contains('1'), 'Force_N'].max()
-                    maxforce_c5 = precon_df.loc[precon_df.Cycle.str.contains('5'), 'Force_N'].max()
-
-                    # Stress-relaxation 
-                    stress_relaxation = (((maxforce_c1-maxforce_c5)/maxforce_c1)*100)
-
-                    ## Pre-conditioning analysis  - hysteresis 
-
-                    # Hysteresis
-                    # Sum of beginning of cycle 1 to last positive value in cycle 1
-                    hysteresis_positive = precon_df.loc[(precon_df.Cycle.str.contains('1')) & (precon_df['Area_under_curve'] > 0), 'Area_under_curve'].sum()
-                    # Sum of first negative value in cycle 5 to last negative value in cycle 5
-                    hysteresis_negative = precon_df.loc[(precon_df.Cycle.str.contains('5')) & (precon_df['Area_under_curve'] < 0), 'Area_under_curve'].sum()
-                    # Add the two together to calculate sum value
-                    hysteresis_sum = hysteresis_positive + hysteresis_negative
-                    # Then calculate percentage
-                    percentage = (hysteresis_sum/hysteresis_positive)*100
-
-
-                    # Hysteresis smooth 
-                    # Repeat the same process but for the smoothed area under the curve values
-                    smooth_hysteresis_positive = precon_df.loc[(precon_df.Cycle.str.contains('1')) & (precon_df['Area_under_curve_smooth'] > 0), 'Area_under_curve_smooth'].sum()
-                    smooth_hysteresis_negative = precon_df.loc[(precon_df.Cycle.str.contains('5')) & (precon_df['Area_under_curve_smooth'] < 0), 'Area_under_curve_smooth'].sum()
-                    smooth_hysteresis_sum = hysteresis_positive + hysteresis_negative
-                    smooth_percentage = (hysteresis_sum/hysteresis_positive)*100
-
-                    ##### STRESS-RELAXATION #####
+else:
+    shard, n_shards = parse_shard(args.shard)
+    shards = assign_shards(list_work_items(dir), n_shards)
+    work_items = [(folder, file) for folder, file, size in shards[shard-1]]
+    print("Shard {} of {}: {} files, {} bytes".format(shard, n_shards, len(work_items), sum(item[2] for item in shards[shard-1])))
 
-                    stress_rate = ((stressrelax_df.iloc[0,5] - stressrelax_df.iloc[6000,5])/60)
+    out_dir = "{}/{}/shard_{}_of_{}".format(dir, args.shard_dir, shard, n_shards)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
 
-                    ##### FAILURE #####
+    # Remove the outputs of any previous attempt at this shard
+    # merge_shards.py takes a results summary to mean the shard finished, so a rerun that crashes mustn't leave the old one
+    for old_output in ['results_summary.csv', 'error_log.csv', 'temp_results_summary.csv']:
+        if os.path.exists("{}/{}".format(out_dir, old_output)):
+            os.remove("{}/{}".format(out_dir, old_output))
 
-                    ## Failure analysis - normalise/correct data
+## Create empty list for the results of all samples analysed and empty arrays for files that couldn't be analysed
+# Results list, one summary row per sample
+all_sample_summary = []
 
-                    # Load correction
-                    #failure_df['Load_correction'] = failure_df['Force_N'] - minf 
-                    failure_df['Load_correction'] = failure_df.iloc[:, 5] - failure_df.iloc[0, 5]
+# Error log array
+# This will contain the names of the files that couldn't be matched to the metadata file 
+error_log = []
+# This will contain the names of files that threw up other errors during the processing 
+error_log_2 = []
 
-                    # Displacement correction 
-                    #failure_df['Displacement_correction'] = failure_df['Displacement_mm'] - minf 
-                    failure_df['Displacement_correction'] = failure_df.iloc[:, 4] - failure_df.iloc[0, 4]
-
-                    # Strain % 
-                    failure_df['Strain_%'] = (failure_df['Displacement_correction']/sample_length)*100
-
-                    # Strain (mm)
-                    failure_df['Strain_mm'] = failure_df['Displacement_correction']/sample_length
-
-                    # Stress (Mpas)
-                    circumference_true = float(sample_metadata.iloc[0,9])
-                    # extract the true circumference value from the metadata
-                    # make use of float fuction to convert string from dataframe into a float value (number with a decimal place)
-                    failure_df['Stress_Mpas'] = failure_df['Load_correction']/circumference_true
-
-                    ## Failure analysis - modulus columns
-
-                    # Need starting point for iteration in the modulus calculation
-                    # To calculate find where stretch phase begins
-                    # Create index for whole failure sheet and just the stretch phase
-                    stretch_index = failure_df.loc[(failure_df.Cycle.str.contains('Stretch'))]
-                    stretch_index = np.array(pd.Index.tolist(stretch_index.index))
-                    failure_index = np.array(pd.Index.tolist(failure_df.index))
-
-                    # 'Stress @ 2positions before stretch as a moving value'
-                    # Subtract the first value in the whole failure sheet index from the point where the stretch cycle starts, then subtract an addition 2 
-                    modulus_start = (stretch_index[0] - failure_index[0]) - 2
-
-                    # Modulus (Mpa)
-                    # The moving value is 10 rows apart, starting 2 positions before stretch
-                    # Hence the +5 and -4 either side of the starting position 
-                    for j in range(modulus_start,failure_df.shape[0]-5):
-                        failure_df.loc[failure_df.index[j],'Modulus_mpa'] = ((failure_df.iloc[j+5,10] - failure_df.iloc[j-4,10])/(failure_df.iloc[j+5,9] - failure_df.iloc[j-4,9]))
-
-                    # Modulus - smooth 
-                    failure_df['Modulus_smooth'] = failure_df['Modulus_mpa'].rolling(window=5).mean()
-
-                    ## Failure analysis - modulus calculations 
-
-                    # Calculate the stress value at which failure occurs
-                    # Then use this to calculate strain, force and extension at which failure occurs
-                    failure_stress = failure_df['Stress_Mpas'].max()
-                    failure_strain_percent = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 8]
-                    failure_force = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 6]
-                    failure_extension = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 7]
-                    failure_time = failure_df.iloc[failure_df['Stress_Mpas'].argmax(), 2]
-
-                    #Subset failure column to remove everything after failure point for max modulus calculation
-                    subset_f = failure_df.iloc[0:failure_df['Stress_Mpas'].argmax(), ]
-
-                    # Calculate max modulus and stress/strain at max modulus on the newly subsetted version of the failure df
-                    # (The full failure df will be the one saved at the end)
-                    max_modulus = subset_f['Modulus_smooth'].max()
-                    stress_at_max_modulus = subset_f.iloc[subset_f['Modulus_smooth'].argmax(), 10]
-                    strain_at_max_modulus = subset_f.iloc[subset_f['Modulus_smooth'].argmax(), 9]
-
-                    ##### PROCESSING #####
-
-                    ## Create directory for output files
-
-                    if not os.path.exists("{}/{}".format(dir, name)):
-                        os.makedirs("{}/{}".format(dir, name))
-
-                    ## Pre-conditioning output 
-
-                    # Pre-conditioning summary tables
-                    force_data = [
-                        ['General summary', ''],
-                        ['Sample length', sample_length],
-                        ['Minimum force', minf],
-                        ['Maximum force', maxforce],
-                        ['Maximum force cycle 1', maxforce_c1],
-                        ['Maximum force cycle 5', maxforce_c5],
-                        ['Stress-relaxtion', stress_relaxation]
-                    ]
-                    force_table = AsciiTable(force_data)
-
-                    hysteresis_data = [
-                        ['Hysteresis', 'Cycl 1-5'],
-                        ['Positive value', hysteresis_positive],
-                        ['Sum value', hysteresis_sum],
-                        ['Hysteresis %', percentage]
-                    ]
-                    hysteresis_table = AsciiTable(hysteresis_data)
-
-                    # Processed precon table as csv
-                    precon_df.to_csv("{}/{}/precon_{}.csv".format(dir, name, name), index=False)
-
-                    # Summary data as .txt file
-                    with open("{}/{}/precon_summary_{}.txt".format(dir, name, name), 'w') as f:
-                        print("Summary data for {} preconditioning...\n".format(name), file=f)
-                        print(force_table.table, file=f) 
-                        print(hysteresis_table.table, file=f) 
-                        f.close()
-
-                    ## Failure output
-
-                    # Failure summary table
-                    modulus_data = [
-                        ['Summary', ''],
-                        ['Max modulus', max_modulus],
-                        ['Stress at max modulus', stress_at_max_modulus],
-                        ['Strain at max modulus', strain_at_max_modulus],
-                        ['Failure stress (MPa)', failure_stress],
-                        ['Failure strain (%)', failure_strain_percent],
-                        ['Failure force (N)', failure_force],
-                        ['Failure extension (mm)', failure_extension]
-                    ]
-                    modulus_table = AsciiTable(modulus_data)
-
-                    # Processed failure table as csv
-                    failure_df.to_csv("{}/{}/failure_{}.csv".format(dir, name, name), index=False)
-
-                    # Summary data as .txt file
-                    with open("{}/{}/failure_summary_{}.txt".format(dir, name, name), 'w') as f:
-                        print("Summary data for {} failure...\n".format(name), file=f)
-                        print(modulus_table.table, file=f) 
-                        f.close()
-
-                    ## Append current sample data to the overall summary
-                    all_sample_summary = all_sample_summary.append({
-                        'File name': name, 
-                        'Date': sample_metadata.iloc[0,0], 
-                        'Sample ID': sample_metadata.iloc[0,1], 
-                        'Replicate number': sample_metadata.iloc[0,6], 
-                        'Sex': sample_metadata.iloc[0,3], 
-                        'Age': sample_metadata.iloc[0,4], 
-                        'Genotype': sample_metadata.iloc[0,5], 
-                        'Sample length': sample_length, 
-                        'Minimum force': minf, 
-                        'Maximum force': maxforce, 
-                        'Maximum force cycle 1': maxforce_c1, 
-                        'Maximum force cycle 5': maxforce_c5,
-                        'Stress-relaxation': stress_relaxation, 
-                        'Rate of change of stress': stress_rate, 
-                        'Hysteresis sum value': hysteresis_sum, 
-                        'Hysteresis %': percentage, 
-                        'Smoothed hysteresis sum value': smooth_hysteresis_sum,
-                        'Smoothed hysteresis %': smooth_percentage, 
-                        'Average diameter': sample_metadata.iloc[0,7], 
-                        'Circumference': sample_metadata.iloc[0,8], 
-                        'Circumference, true': sample_metadata.iloc[0,9],
-                        'Max modulus': max_modulus, 
-                        'Stress at max modulus': stress_at_max_modulus,
-                        'Strain at max modulus': strain_at_max_modulus, 
-                        'Failure stress (MPa)': failure_stress,
-                        'Failure strain (%)': failure_strain_percent,
-                        'Failure force (N)': failure_force,
-                        'Failure extension (mm)': failure_extension,
-                        'Failure time (s)': failure_time}, ignore_index=True)
-
-
-                except:
-                    error_log_2.append(file)
-                    # Write temporary sample summary
-                    all_sample_summary.to_csv("{}/temp_results_summary.csv".format(dir), index=False)
-                    pass
-                
-
-            # If metadata wasn't found originally... 
-            else:
-                print('Metadata not found - check file name against metadata \nSkipping analysis and writing file name to error log')
-                error_log.append(file)
-                print('Moving on to next sample...\n')
+# Records of every file for the results store, grouped by folder
+db_records = []
+
+# Summaries of both engines for every sample, when verifying
+verification = [] if args.verify else None
+tolerances = parse_tolerances(args.tolerance)
+rtol = DEFAULT_TOLERANCES[args.compact][0] if args.rtol is None else args.rtol
+atol = DEFAULT_TOLERANCES[args.compact][1] if args.atol is None else args.atol
+
+##### CHECK FILES #####
+# Script takes in all files in 'work_items' and checks them before analysing any
+# It includes a conditional statement to make sure the file ends in 'Data.csv', so only the relevant files are analysed
+plan = [plan_file(dir, folder, str(file), metadata, failure_only=args.failure_only) for folder, file in work_items if file.endswith('Data.csv')]
+print_plan(plan)
+
+if args.plan:
+    print("Stopping after the run plan ('--plan' given)")
+    sys.exit(0)
+
+if args.compact and not args.verify:
+    print("Compact mode without '--verify', the float32 results won't be checked against the full precision engine\n")
+
+# Files rejected by the plan go straight to the error logs
+for entry in plan:
+    if entry['status'] == 'unmatched':
+        error_log.append(entry['label'])
+    elif entry['status'] == 'error':
+        error_log_2.append(entry['label'])
+    if entry['status'] != 'ok' and args.db is not None:
+        db_records.append(results_db.results_record(entry['file'], entry['status'], None, metadata))
+
+##### ANALYSE FILES #####
+# Largest files first, so a slow file doesn't hold up the end of the run
+for entry in sorted(plan, key=lambda entry: -entry['size']):
+        if entry['status'] == 'ok':
+            folder, file = entry['folder'], entry['file']
+
+            try:
+                sample_summary = analyse_file(entry['dir'], file, entry['sample_metadata'], engine=args.engine,
+                    failure_only=args.failure_only, compact=args.compact, verification=verification)
+
+            except:
+                error_log_2.append(entry['label'])
+                if args.db is not None:
+                    db_records.append(results_db.results_record(file, 'error', None, metadata))
+                # Write temporary sample summary
+                pd.DataFrame(all_sample_summary, columns=SUMMARY_COLUMNS).to_csv("{}/temp_results_summary.csv".format(out_dir), index=False)
+                continue
+
+            if args.db is not None:
+                db_records.append(results_db.results_record(file, 'ok', sample_summary, metadata))
+
+            if args.shard is not None:
+                sample_summary['Folder'] = folder
+            all_sample_summary.append(sample_summary)
 
 
 ## Write final summary table as output 
-all_sample_summary.to_csv("{}/results_summary.csv".format(dir), index=False)
-os.remove("{}/temp_results_summary.csv".format(dir)) 
+# In shard mode the summary gets an extra 'Folder' column, merge_shards.py uses it to split the results back up
+summary_columns = SUMMARY_COLUMNS if args.shard is None else ['Folder'] + SUMMARY_COLUMNS
+all_sample_summary = pd.DataFrame(all_sample_summary, columns=summary_columns)
+
+## Write verification report
+if args.verify:
+    write_verification(out_dir, verification, rtol, atol, tolerances)
 
 ## Write error log as text file
-error_log = np.reshape(error_log, (len(error_log),1))
-error_log_2 = np.reshape(error_log_2, (len(error_log_2),1))
-with open("{}/error_log.txt".format(dir), 'w') as f:
-    print("Error log file:\n The following files couldn't be matched to any data in the metadata file.\n This is usually due to a mismatch in naming, most likely the replicate number.\n".format(name), file=f)
-    print(error_log, file=f) 
-    print("\n An example of a correctly named file that can be matched to the metadata is '210409 MRC Sample B1Data'.\n It begins with date ID, followed by sample ID and replicate ID and ends with 'Data'.", file=f)
-    print("\n\nThe following files had some other problem with the data such as missing failure data.\n".format(name), file=f)
-    print(error_log_2, file=f) 
-    f.close()
+# A failure-only run keeps its own error log, so the full run's is kept too
+error_log_name = "failure_error_log.txt" if args.failure_only else "error_log.txt"
+write_error_log("{}/{}".format(out_dir, error_log_name), error_log, error_log_2)
+
+if args.shard is not None:
+    # Machine readable copy of the error log for merge_shards.py
+    shard_errors = [label.split('/', 1) + ['unmatched'] for label in error_log] + [label.split('/', 1) + ['error'] for label in error_log_2]
+    pd.DataFrame(shard_errors, columns=['Folder', 'File', 'Error']).to_csv("{}/error_log.csv".format(out_dir), index=False)
+
+## Store results
+# One transaction that replaces everything stored for the folder
+if args.db is not None:
+    conn = results_db.connect(args.db)
+    results_db.store_folder(conn, os.path.basename(dir), db_records, replace_folder=True)
+    conn.close()
+    print("Results stored in {}".format(args.db))
+
+# The summary is written last, so its presence shows merge_shards.py that the shard finished
+summary_name = "failure_results_summary.csv" if args.failure_only else "results_summary.csv"
+all_sample_summary.to_csv("{}/{}".format(out_dir, summary_name), index=False)
+if os.path.exists("{}/temp_results_summary.csv".format(out_dir)):
+    os.remove("{}/temp_results_summary.csv".format(out_dir)) 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+### Script to merge the outputs of batch_biomechanics_csv.py run in shard mode
+# Python version 3.6
+# Run in the top-level directory the shards were run in (containing 'date_index.tsv' and the 'shards' directory)
+# Writes 'results_summary.csv' and 'error_log.txt' into each date folder, as a normal run of the batch script would,
+# and the master table 'all_results_summary.csv' for all folders, as 3.combine_results.ipynb would
+# With '--db results.sqlite' the results are also loaded into the results store (see results_db.py)
+# The shards don't write to the store themselves, so this is its only writer, one transaction per folder
+# Required packages: os, pandas, sys, re, argparse, sqlite3
+# Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the script
+
+## Load packages
+
+import pandas as pd
+import os
+import sys
+import re
+import argparse
+import results_db
+from biomechanics_utils import SUMMARY_COLUMNS, read_date_index, write_error_log
+
+## Command line options
+parser = argparse.ArgumentParser(description="Merge shard outputs of batch_biomechanics_csv.py into per-folder results and the master table.")
+parser.add_argument('--shard-dir', default='shards',
+    help="Directory the shard outputs were written to (default: 'shards')")
+parser.add_argument('--db', metavar='PATH',
+    help="Also store the results and error status of every file in this SQLite results store (see results_db.py)")
+args = parser.parse_args()
+
+dir = os.getcwd()
+shard_dir = "{}/{}".format(dir, args.shard_dir)
+
+if not os.path.isdir(shard_dir):
+    sys.exit("Shard directory '{}' not found! Terminating merge...".format(shard_dir))
+
+## Find the shard outputs and check they're all there
+# Shard directories are named 'shard_<i>_of_<N>', all shards need to come from the same N
+shards = {}
+for entry in os.listdir(shard_dir):
+    match = re.match(r'^shard_(\d+)_of_(\d+)$', entry)
+    if match:
+        shards[(int(match.group(1)), int(match.group(2)))] = "{}/{}".format(shard_dir, entry)
+
+n_shards = set(n for i, n in shards)
+if len(n_shards) != 1:
+    sys.exit("Expected the outputs of one sharded run, found shards split {} ways. Remove the outdated shard directories and try again.".format(sorted(n_shards)))
+n_shards = n_shards.pop()
+
+# A shard has finished once it has written its results summary
+missing = [i for i in range(1, n_shards+1) if not os.path.isfile("{}/results_summary.csv".format(shards.get((i, n_shards), '')))]
+if missing:
+    sys.exit("Shards {} of {} haven't finished, rerun them with '--shard i/{}' before merging.".format(missing, n_shards, n_shards))
+
+print("Merging {} shards...".format(n_shards))
+
+# The store needs the metadata for the files that failed, the summaries already have it for the rest
+if args.db is not None:
+    if not os.path.isfile("tendon_data_formatted.csv"):
+        sys.exit("Meta-data not found! '--db' needs 'tendon_data_formatted.csv' in the directory the script is run in. Terminating merge...")
+    metadata = pd.read_csv("./tendon_data_formatted.csv", header=0)
+    metadata = metadata.applymap(str)
+    conn = results_db.connect(args.db)
+
+## Read in the partial summaries and error logs
+# Everything is read as text so the values are copied through exactly as the shards wrote them
+summaries = []
+errors = []
+for i in range(1, n_shards+1):
+    summaries.append(pd.read_csv("{}/results_summary.csv".format(shards[(i, n_shards)]), header=0, dtype=str))
+    errors.append(pd.read_csv("{}/error_log.csv".format(shards[(i, n_shards)]), header=0, dtype=str))
+
+all_sample_summary = pd.concat(summaries, ignore_index=True)
+all_errors = pd.concat(errors, ignore_index=True)
+
+## Write results for each folder
+# Samples are sorted by file name so the output is the same however the files were sharded
+folder_summaries = []
+for folder in read_date_index(dir):
+    if not os.path.isdir("{}/{}".format(dir, folder)):
+        continue
+    print(folder)
+
+    folder_summary = all_sample_summary[all_sample_summary['Folder'] == folder].sort_values('File name')
+    folder_summary = folder_summary[SUMMARY_COLUMNS]
+    folder_summary.to_csv("{}/{}/results_summary.csv".format(dir, folder), index=False)
+    folder_summaries.append(folder_summary)
+
+    folder_errors = all_errors[all_errors['Folder'] == folder].sort_values('File')
+    error_log = list(folder_errors.loc[folder_errors['Error'] == 'unmatched', 'File'])
+    error_log_2 = list(folder_errors.loc[folder_errors['Error'] == 'error', 'File'])
+    write_error_log("{}/{}/error_log.txt".format(dir, folder), error_log, error_log_2)
+
+    # Replaces everything stored for the folder, as a normal run of the batch script would
+    if args.db is not None:
+        records = [results_db.results_record(row['File name'], 'ok', row.to_dict(), metadata) for i, row in folder_summary.iterrows()]
+        records += [results_db.results_record(row['File'], row['Error'], None, metadata) for i, row in folder_errors.iterrows()]
+        results_db.store_folder(conn, folder, records, replace_folder=True)
+
+if args.db is not None:
+    conn.close()
+    print("Results stored in {}".format(args.db))
+
+## Write master table for all folders
+all_data = pd.concat(folder_summaries, ignore_index=True)
+all_data.to_csv("{}/all_results_summary.csv".format(dir), index=False)
+print("Merged results for {} samples written to all_results_summary.csv".format(all_data.shape[0]))
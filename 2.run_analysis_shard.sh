@@ -0,0 +1,19 @@
+#!/bin/bash
+
+## Script to analyse one shard of the whole archive with batch_biomechanics_csv.py, for use as a cluster job array
+# Run in the top-level directory containing 'date_index.tsv', 'tendon_data_formatted.csv' and the date folders
+# Usage: 2.run_analysis_shard.sh <shard number> <number of shards>
+# Shards are numbered from 1, if no shard number is given it's taken from the job array (e.g. SLURM_ARRAY_TASK_ID or SGE_TASK_ID)
+# Once all shards have finished run merge_shards.py in the same directory to write the per-folder and master results
+# A failed shard can be rerun on its own with the same shard number and number of shards
+
+SHARD=${1:-${SLURM_ARRAY_TASK_ID:-${SGE_TASK_ID}}}
+NSHARDS=${2}
+
+if [ -z "${SHARD}" ] || [ -z "${NSHARDS}" ]; then
+   echo "Usage: $0 <shard number> <number of shards>"
+   exit 1
+fi
+
+echo "Shard ${SHARD} of ${NSHARDS}"
+python /mnt/share/EMILYJ-CompMod/biomechanics_organised_python_analysis/batch_biomechanics_csv.py --shard ${SHARD}/${NSHARDS}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+### Script to plot multi-sample overlays of the biomechanics analysis outputs
+# Python version 3.6
+# Run in the top-level directory containing 'date_index.tsv', 'tendon_data_formatted.csv' and the analysed date folders
+# Overlays the failure curves of every sample in a group, e.g. all stress-strain curves for 'Tm1b Wt' at 8 weeks:
+#   python plot_cohort.py --group-by Genotype Age --where Genotype="Tm1b Wt" --where Age=8wks
+# The curves are smoothed and decimated once and kept in a cache ('trace_cache/')
+# Only samples whose 'failure_*.csv' is new or has changed since are read again, so plots render from the cache in seconds
+# The cache only holds the curves, the sample metadata is joined from 'tendon_data_formatted.csv' on every run
+# Required packages: os, pandas, numpy, sys, matplotlib, scipy, re, argparse
+# Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the script
+
+## Load packages
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import re
+import argparse
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+import scipy.signal
+from biomechanics_utils import read_date_index, parse_file_name, match_metadata, metadata_fields
+
+## Curves kept in the cache for each sample
+# Columns of the failure table for x and y, axis labels and the smoothing window used in plot_data.py
+CURVES = {
+    'stress_strain': ('Strain_%', 'Stress_Mpas', 'Strain (%)', 'Stress (MPa)', 101),
+    'force_displacement': ('Displacement_correction', 'Load_correction', 'Displacement (mm)', 'Force (N)', 101)}
+
+# Columns of the cache index - the sample, the size and modification time of the failure table it was made from
+# and the number of points and smoothing windows its curves were made with
+CACHE_COLUMNS = ['Folder', 'File name', 'Source size', 'Source mtime', 'Points', 'Smoothing windows']
+
+# Columns samples can be selected and grouped by - the sample, the IDs from its name and its metadata
+SAMPLE_COLUMNS = ['Folder', 'File name', 'Date_ID', 'Sample_ID', 'Replicate',
+    'Date', 'Sample ID', 'Replicate number', 'Sex', 'Age', 'Genotype', 'Average diameter', 'Circumference', 'Circumference, true']
+
+## Command line options
+parser = argparse.ArgumentParser(description="Overlay the failure curves of all samples in each metadata group.")
+parser.add_argument('--group-by', nargs='+', default=['Genotype'], metavar='COLUMN',
+    help="Metadata columns to group samples by, one figure per group (default: Genotype)")
+parser.add_argument('--where', action='append', default=[], metavar='COLUMN=VALUE',
+    help="Only plot samples with this metadata value, e.g. 'Age=8wks'. Can be given more than once")
+parser.add_argument('--curve', choices=sorted(CURVES), default='stress_strain',
+    help="Curve to overlay (default: stress_strain)")
+parser.add_argument('--out-dir', default='cohort_plots',
+    help="Directory the figures are written to (default: 'cohort_plots')")
+parser.add_argument('--cache-dir', default='trace_cache',
+    help="Directory of the trace cache (default: 'trace_cache')")
+parser.add_argument('--points', type=int, default=500,
+    help="Number of points kept per curve in the cache (default: 500)")
+parser.add_argument('--rebuild', action='store_true',
+    help="Rebuild the cache for every sample, not just new or changed ones")
+args = parser.parse_args()
+
+
+##### TRACE CACHE #####
+
+## Smooth a curve the same way as plot_data.py, then keep 'points' evenly spaced points of it
+# Short curves get a smaller smoothing window, or aren't smoothed at all if they're too short for one
+def decimate_curve(x, y, window, points):
+    window = min(window, len(y) if len(y) % 2 else len(y) - 1)
+    if window > 3:
+        y = scipy.signal.savgol_filter(y, window, 3)
+    keep = np.unique(np.linspace(0, len(y) - 1, min(points, len(y))).astype(int))
+    return x[keep], y[keep]
+
+
+## Find the failure tables of every analysed sample, as (folder, sample name) pairs
+def find_samples(dir):
+    samples = []
+    for folder in read_date_index(dir):
+        if not os.path.isdir("{}/{}".format(dir, folder)):
+            continue
+        for name in sorted(f.name for f in os.scandir("{}/{}".format(dir, folder)) if f.is_dir()):
+            if name.endswith('Data') and os.path.isfile("{}/{}/{}/failure_{}.csv".format(dir, folder, name, name)):
+                samples.append((folder, name))
+    return samples
+
+
+## Load the cache, or an empty one if there isn't one yet
+# Returns the index dataframe and a dict of curves keyed by '<folder>/<sample name>/<curve>/<x or y>'
+def load_cache(cache_dir):
+    if not os.path.isfile("{}/index.csv".format(cache_dir)):
+        return pd.DataFrame(columns=CACHE_COLUMNS), {}
+    index = pd.read_csv("{}/index.csv".format(cache_dir), header=0, dtype=str)
+    with np.load("{}/curves.npz".format(cache_dir)) as npz:
+        curves = {key: npz[key] for key in npz.files}
+    return index, curves
+
+
+## Bring the cache up to date with the failure tables on disk
+# New or changed samples are read and decimated, samples no longer on disk are dropped
+# Samples cached with a different number of points or smoothing windows are read again too
+# The cache is only written back if anything changed
+def update_cache(dir, cache_dir, points, rebuild=False):
+    index, curves = load_cache(cache_dir)
+    cached = {} if rebuild else {(row['Folder'], row['File name']): row for i, row in index.iterrows()}
+
+    rows = []
+    new_curves = {}
+    # Caches written before the metadata was left out of them are rewritten too
+    changed = rebuild or list(index.columns) != CACHE_COLUMNS
+    windows = ' '.join("{}={}".format(curve, CURVES[curve][4]) for curve in sorted(CURVES))
+    for folder, name in find_samples(dir):
+        path = "{}/{}/{}/failure_{}.csv".format(dir, folder, name, name)
+        stat = os.stat(path)
+        key = "{}/{}".format(folder, name)
+
+        row = cached.get((folder, name))
+        if row is not None and row['Source size'] == str(stat.st_size) and row['Source mtime'] == str(stat.st_mtime_ns) \
+                and row.get('Points') == str(points) and row.get('Smoothing windows') == windows \
+                and all("{}/{}/x".format(key, curve) in curves for curve in CURVES):
+            rows.append(row[CACHE_COLUMNS].to_dict())
+            new_curves.update((k, v) for k, v in curves.items() if k.startswith(key + '/'))
+            continue
+
+        print("Caching curves for {}...".format(key))
+        changed = True
+        columns = sorted(set(column for curve in CURVES.values() for column in curve[:2]))
+        failure_df = pd.read_csv(path, header=0, usecols=columns)
+        for curve, (x_column, y_column, x_label, y_label, window) in CURVES.items():
+            x, y = decimate_curve(failure_df[x_column].values, failure_df[y_column].values, window, points)
+            new_curves["{}/{}/x".format(key, curve)] = x.astype('float32')
+            new_curves["{}/{}/y".format(key, curve)] = y.astype('float32')
+
+        rows.append({'Folder': folder, 'File name': name, 'Source size': str(stat.st_size), 'Source mtime': str(stat.st_mtime_ns),
+            'Points': str(points), 'Smoothing windows': windows})
+
+    if len(rows) != index.shape[0]:
+        changed = True
+    index = pd.DataFrame(rows, columns=CACHE_COLUMNS)
+
+    if changed:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez_compressed("{}/curves.npz".format(cache_dir), **new_curves)
+        index.to_csv("{}/index.csv".format(cache_dir), index=False)
+        print("Trace cache updated: {} samples\n".format(index.shape[0]))
+    return index, new_curves
+
+
+## Join the sample metadata to the cached samples
+# Done on every run, so corrections to the metadata file show up without rebuilding the cache
+# A sample whose name doesn't match any metadata keeps empty metadata columns
+def join_metadata(index, metadata):
+    rows = []
+    for i, cached in index.iterrows():
+        row = {'Folder': cached['Folder'], 'File name': cached['File name']}
+        try:
+            name, dateID, sampleID, replicateID = parse_file_name(cached['File name'])
+            row.update({'Date_ID': dateID, 'Sample_ID': sampleID, 'Replicate': replicateID})
+            sample_metadata = match_metadata(metadata, dateID, sampleID, replicateID)
+            if not sample_metadata.empty:
+                row.update(metadata_fields(sample_metadata))
+        except ValueError:
+            pass
+        rows.append(row)
+    return pd.DataFrame(rows, columns=SAMPLE_COLUMNS).astype(str)
+
+
+##### PLOT DATA #####
+
+## Make a file name safe version of a group's values, e.g. 'Genotype-Tm1b_Wt_Age-8wks'
+def group_label(group_by, values):
+    return '_'.join("{}-{}".format(column, re.sub(r'[^A-Za-z0-9.]+', '_', str(value))) for column, value in zip(group_by, values))
+
+
+## Overlay the curves of every sample in one group
+def plot_group(samples, curves, curve, title, path):
+    x_column, y_column, x_label, y_label, window = CURVES[curve]
+
+    plt.figure()
+    for i, row in samples.iterrows():
+        key = "{}/{}/{}".format(row['Folder'], row['File name'], curve)
+        plt.plot(curves[key + '/x'], curves[key + '/y'], '-', linewidth=1, alpha=0.7, label=row['File name'])
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
+    plt.title(title, fontsize=12)
+    # A legend with more than 10 samples covers the plot
+    if samples.shape[0] <= 10:
+        plt.legend(fontsize=6)
+    plt.savefig(path, bbox_inches='tight', dpi=300)
+    plt.close()
+
+
+## Read in data
+dir = os.getcwd()
+
+if os.path.isfile("tendon_data_formatted.csv"):
+    metadata = pd.read_csv("./tendon_data_formatted.csv", header=0)
+    metadata = metadata.applymap(str)
+else:
+    sys.exit("Meta-data not found! Please make sure 'tendon_data_formatted.csv' is present in the directory the script is run in. Terminating plotting...")
+
+index, curves = update_cache(dir, "{}/{}".format(dir, args.cache_dir), args.points, args.rebuild)
+samples = join_metadata(index, metadata)
+
+## Select and group samples by their metadata
+for column in args.group_by:
+    if column not in SAMPLE_COLUMNS:
+        sys.exit("Can't group by '{}', choose from: {}".format(column, ', '.join(SAMPLE_COLUMNS)))
+
+selected = samples
+for condition in args.where:
+    column, _, value = condition.partition('=')
+    if column not in SAMPLE_COLUMNS:
+        sys.exit("Can't filter on '{}', choose from: {}".format(column, ', '.join(SAMPLE_COLUMNS)))
+    selected = selected[selected[column] == value]
+
+# Samples without metadata can't be grouped
+selected = selected[selected['Genotype'] != 'nan']
+if selected.empty:
+    sys.exit("No samples match {}".format(' and '.join(args.where) or 'the metadata'))
+
+if not os.path.exists(args.out_dir):
+    os.makedirs(args.out_dir)
+
+for values, samples in selected.groupby(args.group_by):
+    values = values if isinstance(values, tuple) else (values,)
+    title = "{} - {} samples".format(', '.join(str(value) for value in values), samples.shape[0])
+    path = "{}/{}_{}.png".format(args.out_dir, args.curve, group_label(args.group_by, values))
+    print('Plotting {}...'.format(title))
+    plot_group(samples, curves, args.curve, title, path)
+
+print("Figures written to {}".format(args.out_dir))
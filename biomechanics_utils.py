@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+### Shared helpers for the biomechanics analysis scripts
+# Python version 3.6
+# Imported by batch_biomechanics_csv.py and merge_shards.py, keep it in the same directory as those scripts
+# Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the scripts
+
+## Load packages
+
+import os
+import re
+import numpy as np
+
+## Columns of the results summary written for every analysed folder
+SUMMARY_COLUMNS = ['File name', 'Date', 'Sample ID', 'Replicate number', 'Sex', 'Age', 'Genotype',
+    'Sample length', 'Minimum force', 'Maximum force', 'Maximum force cycle 1', 'Maximum force cycle 5', 'Stress-relaxation', 'Rate of change of stress',
+    'Hysteresis sum value', 'Hysteresis %', 'Smoothed hysteresis sum value', 'Smoothed hysteresis %',
+    'Average diameter', 'Circumference', 'Circumference, true', 'Max modulus', 'Stress at max modulus', 'Strain at max modulus', 'Failure stress (MPa)',
+    'Failure strain (%)', 'Failure force (N)', 'Failure extension (mm)', 'Failure time (s)']
+
+
+## Read the names of the date folders from the first column of 'date_index.tsv'
+def read_date_index(dir):
+    folders = []
+    with open("{}/date_index.tsv".format(dir)) as f:
+        for line in f:
+            folder = line.rstrip('\n').split('\t')[0].strip()
+            if folder:
+                folders.append(folder)
+    return folders
+
+
+## Split a data file name into its date, sample and replicate IDs
+# e.g. '210409 MRC Sample B1Data.csv' gives ('210409 MRC Sample B1Data', '210409', 'B', '1')
+# Raises ValueError if the name doesn't have that layout, as it can't then be matched to the metadata
+def parse_file_name(file):
+    name = os.path.splitext(file)[0]
+    excel_annotation = re.split(r'(\d+)', name)
+    if len(excel_annotation) < 4 or not excel_annotation[2]:
+        raise ValueError("File name '{}' doesn't contain a date ID, sample ID and replicate ID".format(file))
+    sampleID = excel_annotation[2][-1]
+    dateID = excel_annotation[1]
+    replicateID = excel_annotation[3]
+    return name, dateID, sampleID, replicateID
+
+
+## Write the error log as a text file
+# 'error_log' holds files that couldn't be matched to the metadata, 'error_log_2' files that failed during processing
+def write_error_log(path, error_log, error_log_2):
+    error_log = np.reshape(error_log, (len(error_log),1))
+    error_log_2 = np.reshape(error_log_2, (len(error_log_2),1))
+    with open(path, 'w') as f:
+        print("Error log file:\n The following files couldn't be matched to any data in the metadata file.\n This is usually due to a mismatch in naming, most likely the replicate number.\n", file=f)
+        print(error_log, file=f)
+        print("\n An example of a correctly named file that can be matched to the metadata is '210409 MRC Sample B1Data'.\n It begins with date ID, followed by sample ID and replicate ID and ends with 'Data'.", file=f)
+        print("\n\nThe following files had some other problem with the data such as missing failure data.\n", file=f)
+        print(error_log_2, file=f)
+
+
+## Find the metadata rows matching a sample's date, sample and replicate IDs
+# 'metadata' is 'tendon_data_formatted.csv' read in with every value as a string
+def match_metadata(metadata, dateID, sampleID, replicateID):
+    return metadata.loc[(metadata.Date_ID == dateID) & (metadata.Sample_ID == sampleID) & (metadata.Replicate == replicateID)]
+
+
+## Summary columns taken from the sample's metadata
+def metadata_fields(sample_metadata):
+    return {
+        'Date': sample_metadata.iloc[0,0],
+        'Sample ID': sample_metadata.iloc[0,1],
+        'Replicate number': sample_metadata.iloc[0,6],
+        'Sex': sample_metadata.iloc[0,3],
+        'Age': sample_metadata.iloc[0,4],
+        'Genotype': sample_metadata.iloc[0,5],
+        'Average diameter': sample_metadata.iloc[0,7],
+        'Circumference': sample_metadata.iloc[0,8],
+        'Circumference, true': sample_metadata.iloc[0,9]}
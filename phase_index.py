@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+### Phase offset index for the biomechanics data files
+# Python version 3.6
+# Records where each 'SetName' phase (pre-conditioning, stress-relaxation, failure) sits in a '*Data.csv' file,
+# as byte offsets and row counts, so a phase can be read on its own without parsing the whole file
+# The index is built once and saved next to the file as '<file>.index.json'
+# It's rebuilt automatically if the data file changes
+# Used by batch_biomechanics_csv.py, can also be run as a script to build the indexes ahead of time, e.g.
+#   python phase_index.py *Data.csv
+# Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the script
+
+## Load packages
+
+import os
+import io
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+## 'SetName' values of the three phases, matched the same way as 'str.contains' in the analysis
+PRECON = '5x pre-conditioning'
+STRESSRELAX = 'Stress-relax'
+FAILURE = 'Failure'
+
+## Layout version of the saved indexes, an index saved with an older version is rebuilt
+# Version 2 fixed the byte offsets of files with blank lines in them
+INDEX_VERSION = 2
+
+# Bytes that don't count as content, pandas skips lines with nothing else on them
+BLANK_BYTES = [9, 10, 13, 32]
+
+
+## Path of the index saved alongside a data file
+def index_path(path):
+    return path + '.index.json'
+
+
+## Type of a column as read by pandas - 'int', 'float', 'bool' or 'str'
+def dtype_kind(dtype):
+    if dtype.kind in 'iu':
+        return 'int'
+    if dtype.kind == 'f':
+        return 'float'
+    if dtype.kind == 'b':
+        return 'bool'
+    return 'str'
+
+
+## Combine the types of a column from two parts of the file into the type pandas gives the whole column
+def merge_kind(kind, other):
+    if kind == other:
+        return kind
+    if set([kind, other]) == set(['int', 'float']):
+        return 'float'
+    return 'str'
+
+
+## Byte offset of the end of each of the requested lines (counted from 0, the header is line 0)
+# Blank lines aren't counted, the same as when pandas reads the file, and belong to the line before them
+# Streams the file in blocks and finds the line ends with numpy, so it never holds the whole file
+def line_ends(path, lines, block_size=2**24):
+    wanted = np.unique(np.asarray(lines, dtype='int64'))
+    ends = {}
+    seen = 0
+    offset = 0
+    # Number of content bytes since the last line end, carried over from one block to the next
+    carry = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            content = np.cumsum(~np.isin(data, BLANK_BYTES))
+            newlines = np.flatnonzero(data == 10)
+            if len(newlines):
+                line_content = np.diff(np.concatenate([[-carry], content[newlines]]))
+                carry = int(content[-1] - content[newlines[-1]])
+                newlines = newlines[line_content > 0] + offset + 1
+            else:
+                carry += int(content[-1])
+            in_block = wanted[(wanted >= seen) & (wanted < seen + len(newlines))]
+            ends.update(zip(in_block.tolist(), newlines[in_block - seen].tolist()))
+            seen += len(newlines)
+            offset += len(block)
+    # A last line without a newline ends at the end of the file
+    return [ends.get(line, offset) for line in lines]
+
+
+## Build the index for a data file
+# Each run of consecutive rows with the same 'SetName' gets its byte range, first row number and row count
+# Column types are recorded for the whole file, so reading part of it gives the same types as reading all of it
+# The file is read in chunks with the pandas parser, then scanned once more for the byte offsets of the runs
+def build_index(path, chunksize=100000):
+    stat = os.stat(path)
+    columns = list(pd.read_csv(path, header=0, nrows=0).columns)
+    kinds = None
+    runs = []
+    row = 0
+    for chunk in pd.read_csv(path, header=0, chunksize=chunksize):
+        chunk_kinds = [dtype_kind(dtype) for dtype in chunk.dtypes]
+        kinds = chunk_kinds if kinds is None else [merge_kind(a, b) for a, b in zip(kinds, chunk_kinds)]
+
+        setnames = chunk['SetName'].astype(str).values
+        starts = [0] + (np.flatnonzero(setnames[1:] != setnames[:-1]) + 1).tolist()
+        for start, end in zip(starts, starts[1:] + [len(setnames)]):
+            if runs and runs[-1]['SetName'] == setnames[start] and start == 0:
+                runs[-1]['rows'] += end - start
+            else:
+                runs.append({'SetName': setnames[start], 'first_row': row + start, 'rows': end - start})
+        row += len(chunk)
+
+    # Data row r is line r+1 of the file (not counting blank lines), so it starts where line r ends
+    ends = line_ends(path, [0] + [run['first_row'] for run in runs] + [run['first_row'] + run['rows'] for run in runs])
+    header_end = ends[0]
+    for run, start, end in zip(runs, ends[1:len(runs)+1], ends[len(runs)+1:]):
+        run['start'] = start
+        run['end'] = end
+
+    return {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'header_end': header_end,
+        'columns': columns, 'kinds': kinds or ['float'] * len(columns), 'rows': row, 'runs': runs}
+
+
+## Saved index for a data file, or None if there isn't one, it's an older version or the file has changed since it was built
+def cached_index(path):
+    if not os.path.isfile(index_path(path)):
+        return None
+    stat = os.stat(path)
+    try:
+        with open(index_path(path)) as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    if index.get('version') == INDEX_VERSION and index.get('size') == stat.st_size and index.get('mtime_ns') == stat.st_mtime_ns:
+        return index
+    return None
+
+
+## Load the index for a data file, building and saving it if it's missing or out of date
+# If the index can't be saved (e.g. read-only data) it's still returned for this run
+def load_index(path):
+    index = cached_index(path)
+    if index is not None:
+        return index
+
+    index = build_index(path)
+    try:
+        with open(index_path(path), 'w') as f:
+            json.dump(index, f)
+    except (IOError, OSError):
+        print("Couldn't save phase index for {}, continuing without saving it".format(path))
+    return index
+
+
+## Number of rows in each phase of the index, matched the same way as 'str.contains'
+def phase_rows(index, phase):
+    return sum(run['rows'] for run in index['runs'] if phase in run['SetName'])
+
+
+## Read one phase of a data file into a dataframe, using the index to skip the rest of the file
+# 'nrows' limits how many rows of the phase are read, e.g. when only the start of the phase is needed
+# The dataframe has the same columns, types and row labels as the phase would have when read from the whole file
+# 'float_dtype' can be set to 'float32' and 'str_dtype' to 'category' to save memory, see compact mode in batch_biomechanics_csv.py
+def read_phase(path, index, phase, nrows=None, float_dtype='float64', str_dtype=str):
+    dtypes = {'int': 'int64', 'float': float_dtype, 'bool': 'bool', 'str': str_dtype}
+    dtype = {column: dtypes[kind] for column, kind in zip(index['columns'], index['kinds'])}
+
+    chunks = []
+    labels = []
+    remaining = nrows
+    with open(path, 'rb') as f:
+        chunks.append(f.read(index['header_end']))
+        for run in index['runs']:
+            if phase not in run['SetName']:
+                continue
+            if remaining is not None and remaining <= 0:
+                break
+
+            f.seek(run['start'])
+            if remaining is None or remaining >= run['rows']:
+                chunks.append(f.read(run['end'] - run['start']))
+                labels.extend(range(run['first_row'], run['first_row'] + run['rows']))
+                if remaining is not None:
+                    remaining -= run['rows']
+            else:
+                # Blank lines don't count towards the rows read
+                read = 0
+                while read < remaining:
+                    line = f.readline()
+                    if not line:
+                        break
+                    chunks.append(line)
+                    read += len(line.strip()) > 0
+                labels.extend(range(run['first_row'], run['first_row'] + remaining))
+                remaining = 0
+
+    phase_df = pd.read_csv(io.BytesIO(b''.join(chunks)), header=0, dtype=dtype)
+    # Rows from outside the phase mean the index doesn't match the file, which would give wrong results without any error
+    if len(phase_df) != len(labels) or not phase_df['SetName'].astype(str).str.contains(phase, regex=False).all():
+        raise ValueError("Phase index of {} doesn't match the file, rows from outside the '{}' phase were read".format(path, phase))
+    phase_df.index = pd.Index(labels, dtype='int64')
+    return phase_df
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        index = load_index(path)
+        print("{}: {} rows, {} pre-conditioning, {} stress-relaxation, {} failure".format(path, index['rows'],
+            phase_rows(index, PRECON), phase_rows(index, STRESSRELAX), phase_rows(index, FAILURE)))
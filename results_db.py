@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+### SQLite results store for the biomechanics analysis
+# Python version 3.6
+# Optional - batch_biomechanics_csv.py writes to it when run with '--db results.sqlite' in a date folder,
+# and merge_shards.py with '--db results.sqlite' after a sharded run
+# Holds one row per analysed file: the summary metrics, the joined sample metadata and whether the analysis worked
+# Indexed on Date_ID, Sample_ID, Replicate and Genotype so looking up samples doesn't need to scan every results_summary.csv
+# Can also be run as a script to query the store, e.g.
+#   python results_db.py results.sqlite --genotype "Tm1b Wt" --age 8wks --out tm1b_wt_8wks.csv
+#   python results_db.py results.sqlite --date-id 210409 --sample-id B --replicate 1
+# Required packages: os, sys, sqlite3, pandas, argparse (sqlite3 comes with python)
+# Contact Emily Johnson at ejohn16@liv.ac.uk or em.j.johnson.93@gmail.com if you're having trouble with the script
+
+## Load packages
+
+import os
+import sys
+import sqlite3
+import argparse
+import pandas as pd
+from biomechanics_utils import SUMMARY_COLUMNS, parse_file_name, match_metadata, metadata_fields
+
+## Layout of the results table
+# Key columns come first: the date folder, file name, the IDs parsed from the file name and the analysis status
+# Status is 'ok', 'unmatched' (no metadata for the file name) or 'error' (the analysis failed)
+# The IDs are kept even when there's no metadata, so failed files can be found the same way as analysed ones
+KEY_COLUMNS = ['Folder', 'File name', 'Date_ID', 'Sample_ID', 'Replicate', 'Status']
+
+# Text columns of the summary, everything else is stored as a number
+TEXT_COLUMNS = ['Folder', 'File name', 'Date_ID', 'Sample_ID', 'Replicate', 'Status',
+    'Date', 'Sample ID', 'Replicate number', 'Sex', 'Age', 'Genotype']
+
+COLUMNS = KEY_COLUMNS + [column for column in SUMMARY_COLUMNS if column != 'File name']
+
+# Query options of the command line and the columns they filter on
+FILTERS = [('date_id', 'Date_ID'), ('sample_id', 'Sample_ID'), ('replicate', 'Replicate'),
+    ('genotype', 'Genotype'), ('sex', 'Sex'), ('age', 'Age'), ('status', 'Status')]
+
+
+## Quote a column name for SQL, the summary column names contain spaces and brackets
+def quote(column):
+    return '"{}"'.format(column.replace('"', '""'))
+
+
+## Convert a value for sqlite, which doesn't understand numpy numbers or NaN
+def to_sql_value(value):
+    if value is None or pd.isnull(value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+## Record of one file for the results store
+# Has the IDs from the file name and the analysis status, plus the metadata and metrics where there are any
+def results_record(file, status, sample_summary, metadata):
+    record = {'File name': os.path.splitext(file)[0], 'Status': status}
+    try:
+        name, dateID, sampleID, replicateID = parse_file_name(file)
+    except ValueError:
+        return record
+    record.update({'Date_ID': dateID, 'Sample_ID': sampleID, 'Replicate': replicateID})
+
+    if sample_summary is not None:
+        record.update(sample_summary)
+    else:
+        sample_metadata = match_metadata(metadata, dateID, sampleID, replicateID)
+        if not sample_metadata.empty:
+            record.update(metadata_fields(sample_metadata))
+    return record
+
+
+## Open the results store, creating the table and indexes if it's new
+# Only one process should write to the store at a time, SQLite's file locking isn't reliable on network shares
+# so a sharded run leaves the writing to merge_shards.py rather than having every shard write
+def connect(path):
+    conn = sqlite3.connect(path)
+    columns = ["{} {}".format(quote(column), 'TEXT' if column in TEXT_COLUMNS else 'REAL') for column in COLUMNS]
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS results ({}, PRIMARY KEY (Folder, {}))".format(', '.join(columns), quote('File name')))
+        conn.execute("CREATE INDEX IF NOT EXISTS results_sample ON results (Date_ID, Sample_ID, Replicate)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_sample_id ON results (Sample_ID)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_replicate ON results (Replicate)")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_genotype ON results (Genotype)")
+    return conn
+
+
+## Write the results for one folder in a single transaction
+# 'records' is a list of dicts keyed by column name, missing columns are stored as NULL
+# Files analysed again replace their previous row
+# With 'replace_folder' any rows left over from files no longer in the folder are removed too
+def store_folder(conn, folder, records, replace_folder=False):
+    rows = []
+    for record in records:
+        record = dict(record, Folder=folder)
+        rows.append([to_sql_value(record.get(column)) for column in COLUMNS])
+
+    with conn:
+        if replace_folder:
+            conn.execute("DELETE FROM results WHERE Folder = ?", (folder,))
+        conn.executemany("INSERT OR REPLACE INTO results ({}) VALUES ({})".format(
+            ', '.join(quote(column) for column in COLUMNS), ', '.join('?' * len(COLUMNS))), rows)
+
+
+## Look up results, filtering on any of the columns by exact value
+# e.g. query(conn, Genotype='Tm1b Wt', Age='8wks') - returns a dataframe with the same columns as the store
+def query(conn, **filters):
+    where = ' AND '.join("{} = ?".format(quote(column)) for column in filters)
+    sql = "SELECT * FROM results"
+    if where:
+        sql += " WHERE " + where
+    sql += " ORDER BY Folder, {}".format(quote('File name'))
+    return pd.read_sql_query(sql, conn, params=list(filters.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the biomechanics results store.")
+    parser.add_argument('db', help="Path to the SQLite results store")
+    for option, column in FILTERS:
+        parser.add_argument('--' + option.replace('_', '-'), help="Only results with this {}".format(column))
+    parser.add_argument('--out', help="Write the results to this .csv file instead of printing them")
+    args = parser.parse_args()
+
+    # Connecting would create an empty store at a mistyped path, rather than say it isn't there
+    if not os.path.isfile(args.db):
+        sys.exit("Results store '{}' not found! Check the path and try again.".format(args.db))
+
+    filters = {column: getattr(args, option) for option, column in FILTERS if getattr(args, option) is not None}
+    results = query(connect(args.db), **filters)
+
+    if args.out:
+        results.to_csv(args.out, index=False)
+        print("{} results written to {}".format(results.shape[0], args.out))
+    else:
+        print(results.to_string(index=False))